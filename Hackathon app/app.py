@@ -4,22 +4,144 @@ import io
 import json
 import time
 import html
+import hashlib
 import smtplib
+import threading
 from email.message import EmailMessage
-from typing import List, Dict, Any, Optional, Tuple
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, List, Dict, Any, Iterator, Optional, Tuple, Union
 
-import requests
+import httpx
+import diskcache
+import orjson
 import pandas as pd
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
 from io import BytesIO
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_LEFT
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from types import SimpleNamespace
+
+if TYPE_CHECKING:
+    import chromadb
+
+
+# ----------------- PDF STYLES -----------------
+# ReportLab is imported on first export rather than on every script run.
+@st.cache_resource
+def _get_reportlab() -> SimpleNamespace:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    return SimpleNamespace(
+        A4=A4,
+        colors=colors,
+        getSampleStyleSheet=getSampleStyleSheet,
+        ParagraphStyle=ParagraphStyle,
+        SimpleDocTemplate=SimpleDocTemplate,
+        Paragraph=Paragraph,
+        Spacer=Spacer,
+        Table=Table,
+        TableStyle=TableStyle,
+    )
+
+@st.cache_resource
+def get_pdf_styles():
+    rl = _get_reportlab()
+    styles = rl.getSampleStyleSheet()
+    styles.add(rl.ParagraphStyle(name='CustomBody', fontSize=11, leading=16))
+    styles.add(rl.ParagraphStyle(name='TableCell', fontSize=8, leading=10))
+    return styles
+
+PDF_MARGIN = 72  # SimpleDocTemplate's default 1-inch margins
+URL_RE = re.compile(r"(https?://[^\s)]+)")
+
+def _md_table_cells(line: str) -> List[str]:
+    return [cell.strip() for cell in line.strip().strip("|").split("|")]
+
+def _is_md_table_separator(line: str) -> bool:
+    cells = _md_table_cells(line)
+    return line.lstrip().startswith("|") and all(c and "-" in c and set(c) <= set("-: ") for c in cells)
+
+def _md_table(rows: List[List[str]]) -> Any:
+    rl = _get_reportlab()
+    ncols = len(rows[0])
+    cell_style = get_pdf_styles()['TableCell']
+    data = [[rl.Paragraph(html.escape(cell), cell_style) for cell in (row + [""] * ncols)[:ncols]] for row in rows]
+    frame_width = rl.A4[0] - 2 * PDF_MARGIN
+    return rl.Table(
+        data,
+        colWidths=[frame_width / ncols] * ncols,
+        repeatRows=1,
+        style=rl.TableStyle([
+            ("GRID", (0, 0), (-1, -1), 0.5, rl.colors.grey),
+            ("BACKGROUND", (0, 0), (-1, 0), rl.colors.lightgrey),
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+        ]),
+    )
 
+def _block_paragraphs(md: str, transform: Callable[[str], str] = html.escape, spacing: float = 0) -> List[Any]:
+    # One Paragraph per "\n\n" block: ReportLab re-wraps the rest of a Paragraph
+    # at every page split, so a single report-sized Paragraph builds far slower.
+    # `transform` must escape the text so "<" in LLM output can't break the markup.
+    rl = _get_reportlab()
+    body = get_pdf_styles()['CustomBody']
+    flow: List[Any] = []
+    for block in md.split("\n\n"):
+        block = block.strip()
+        if block:
+            flow.append(rl.Paragraph(transform(block), body))
+            if spacing:
+                flow.append(rl.Spacer(1, spacing))
+    return flow
+
+def _escape_and_link(text: str) -> str:
+    return URL_RE.sub(r"<font color='#0000FF'>\1</font>", html.escape(text))
+
+def md_to_flowables(md: str) -> List[Any]:
+    # Markdown tables (header row, then a |---| separator) become one Table;
+    # the text between them is split into a Paragraph per block.
+    rl = _get_reportlab()
+    flow: List[Any] = []
+    text_lines: List[str] = []
+
+    def flush_text() -> None:
+        flow.extend(_block_paragraphs("\n".join(text_lines)))
+        text_lines.clear()
+
+    lines = md.split("\n")
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.lstrip().startswith("|") and i + 1 < len(lines) and _is_md_table_separator(lines[i + 1]):
+            flush_text()
+            rows = [_md_table_cells(line)]
+            i += 2
+            while i < len(lines) and lines[i].lstrip().startswith("|"):
+                rows.append(_md_table_cells(lines[i]))
+                i += 1
+            flow.append(_md_table(rows))
+            flow.append(rl.Spacer(1, 8))
+            continue
+        text_lines.append(line)
+        i += 1
+    flush_text()
+    return flow
+
+def render_pdf(flow: List[Any]) -> bytes:
+    rl = _get_reportlab()
+    buffer = BytesIO()
+    rl.SimpleDocTemplate(buffer, pagesize=rl.A4).build(flow)
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False)
+def md_to_pdf(md: str) -> bytes:
+    # Cached so reruns from unrelated widgets don't rebuild an unchanged report.
+    return render_pdf(md_to_flowables(md))
+
+def updates_md_to_pdf(md: str) -> bytes:
+    return render_pdf(_block_paragraphs(md, transform=_escape_and_link, spacing=8))
 
 # ----------------- Redirect Button -----------------
 st.set_page_config(page_title="Competitor Discovery AI", layout="wide")
@@ -67,7 +189,7 @@ EMAIL_SENDER_ADDRESS = os.getenv("EMAIL_SENDER_ADDRESS")
 EMAIL_SENDER_PASSWORD = os.getenv("EMAIL_SENDER_PASSWORD")
 
 # ----------------- EMAIL FUNCTION -----------------
-def send_email_with_pdf(to_email, pdf_bytes, filename="Competitor_Report.pdf"):
+def send_email_with_pdf(to_email, pdf_bytes, smtp_state, filename="Competitor_Report.pdf"):
     msg = EmailMessage()
     msg['Subject'] = "Your Competitor Report is Ready!"
     msg['From'] = EMAIL_SENDER_ADDRESS
@@ -76,15 +198,55 @@ def send_email_with_pdf(to_email, pdf_bytes, filename="Competitor_Report.pdf"):
 
     msg.add_attachment(pdf_bytes, maintype='application', subtype='pdf', filename=filename)
 
+    # Runs on the email executor, so failures propagate through the Future
+    # instead of calling st.error from a thread without a script context.
+    smtp_send(smtp_state, msg)
+    return True
+
+@st.cache_resource
+def get_email_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="email")
+
+@st.cache_resource
+def get_smtp_state() -> Dict[str, Any]:
+    # One logged-in connection shared across sends; the lock serialises its use.
+    return {"conn": None, "lock": threading.Lock()}
+
+def _smtp_connect() -> smtplib.SMTP_SSL:
+    smtp = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+    smtp.login(EMAIL_SENDER_ADDRESS, EMAIL_SENDER_PASSWORD)
+    return smtp
+
+def _smtp_is_alive(smtp: smtplib.SMTP_SSL) -> bool:
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-            smtp.login(EMAIL_SENDER_ADDRESS, EMAIL_SENDER_PASSWORD)
-            smtp.send_message(msg)
-        return True
-    except Exception as e:
-        st.error(f"Email sending failed: {e}")
+        return smtp.noop()[0] == 250
+    except OSError:  # includes smtplib.SMTPException
         return False
 
+def _is_dead_connection_error(err: OSError) -> bool:
+    # A timed-out Gmail session answers 421 (sendmail then closes it and raises
+    # SMTPSenderRefused); socket-level errors mean the same. Other SMTP errors,
+    # such as refused recipients, would fail again after reconnecting.
+    if isinstance(err, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(err, smtplib.SMTPResponseException):
+        return err.smtp_code == 421
+    return not isinstance(err, smtplib.SMTPException)
+
+def smtp_send(smtp_state: Dict[str, Any], msg: EmailMessage) -> None:
+    with smtp_state["lock"]:
+        conn = smtp_state["conn"]
+        if conn is None or not _smtp_is_alive(conn):
+            smtp_state["conn"] = _smtp_connect()
+        try:
+            smtp_state["conn"].send_message(msg)
+        except OSError as err:
+            if not _is_dead_connection_error(err):
+                raise
+            # The server dropped the session between the check and the send; reconnect once.
+            smtp_state["conn"] = _smtp_connect()
+            smtp_state["conn"].send_message(msg)
+
 # ----------------- TITLE -----------------
 st.title("🔍 Competitor Discovery & Comparison AI")
 
@@ -102,20 +264,56 @@ compare_performance = st.checkbox("Speed / Performance")
 compare_security = st.checkbox("Security / Compliance")
 compare_scalability = st.checkbox("Scalability / Enterprise Readiness")
 
-selected_aspects = []
-if compare_ui: selected_aspects.append("User Interface")
-if compare_features: selected_aspects.append("Features")
-if compare_pricing: selected_aspects.append("Pricing")
-if compare_community: selected_aspects.append("Community Support")
-if compare_integrations: selected_aspects.append("Integrations")
-if compare_performance: selected_aspects.append("Speed / Performance")
-if compare_security: selected_aspects.append("Security / Compliance")
-if compare_scalability: selected_aspects.append("Scalability / Enterprise Readiness")
+_ASPECTS = (
+    ("User Interface", compare_ui),
+    ("Features", compare_features),
+    ("Pricing", compare_pricing),
+    ("Community Support", compare_community),
+    ("Integrations", compare_integrations),
+    ("Speed / Performance", compare_performance),
+    ("Security / Compliance", compare_security),
+    ("Scalability / Enterprise Readiness", compare_scalability),
+)
+selected_aspects = [name for name, flag in _ASPECTS if flag]
+
+# ----------------- HTTP / CACHES / CONCURRENCY -----------------
+# One pooled HTTP/2 client so repeated calls to SerpAPI, OpenRouter and
+# competitor sites reuse keep-alive connections and multiplex streams. Cached
+# so Streamlit reruns don't open a fresh connection pool each time.
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    return httpx.Client(
+        http2=True,
+        timeout=30.0,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+    )
+
+SESSION = get_http_client()
+
+@st.cache_resource
+def get_disk_cache(directory: str) -> diskcache.Cache:
+    return diskcache.Cache(directory)
+
+def thread_pool(max_workers: int) -> ThreadPoolExecutor:
+    # Workers inherit the script context so st.* calls (e.g. st.error) still render.
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    )
 
 # ----------------- SERP API -----------------
 SERP_SEARCH_URL = "https://serpapi.com/search.json"
+SERP_CACHE_TTL = 86400  # seconds
+
+serp_cache = get_disk_cache(".serp_cache")
 
 def serp_search(query: str, engine: str = "google", num: int = 10) -> Dict[str, Any]:
+    cache_key = f"{engine}|{num}|{query}"
+    cached = serp_cache.get(cache_key)
+    if cached is not None:
+        return cached
     params = {
         "engine": engine,
         "q": query,
@@ -123,14 +321,77 @@ def serp_search(query: str, engine: str = "google", num: int = 10) -> Dict[str,
         "api_key": SERPAPI_API_KEY,
     }
     try:
-        r = requests.get(SERP_SEARCH_URL, params=params, timeout=30)
+        r = SESSION.get(SERP_SEARCH_URL, params=params, timeout=30)
         r.raise_for_status()
-        return r.json()
+        data = orjson.loads(r.content)
+        serp_cache.set(cache_key, data, expire=SERP_CACHE_TTL)
+        return data
     except Exception as e:
         print(f"[SERP ERROR] {e}")
         return {}
 
-def fetch_product_description(product_name: str, niche: str) -> str:
+# ----------------- SEMANTIC CACHE -----------------
+# Near-duplicate inputs ("Notion / productivity" vs "Notion.so / note taking")
+# reuse earlier results instead of paying for SERP and LLM round-trips again.
+SEMANTIC_CACHE_DIR = ".sem_cache"
+SEMANTIC_CACHE_MAX_DISTANCE = 0.15
+SEMANTIC_CACHE_TTL = 86400  # seconds, same as the LLM response cache
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+# chromadb (and the embedding model behind it) is imported on first use rather
+# than on every script run.
+@st.cache_resource
+def get_semantic_client() -> "chromadb.ClientAPI":
+    import chromadb
+    return chromadb.PersistentClient(path=SEMANTIC_CACHE_DIR)
+
+@st.cache_resource
+def get_semantic_collection(name: str) -> "chromadb.Collection":
+    from chromadb.utils import embedding_functions
+    embed = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL)
+    return get_semantic_client().get_or_create_collection(
+        name, embedding_function=embed, metadata={"hnsw:space": "cosine"}
+    )
+
+def normalize_product_name(name: str) -> str:
+    # "Notion", "notion.so" and " Notion " all map to "notion".
+    return "".join(ch for ch in name.strip().lower().split(".")[0] if ch.isalnum())
+
+def semantic_lookup(collection_name: str, key_text: str, filters: Dict[str, str]) -> Optional[str]:
+    # Only the free-text key is matched by embedding distance; `filters` must match
+    # exactly, so a nearby key for another product or aspect set can't hit.
+    where = {"$and": [{k: v} for k, v in filters.items()] + [{"created_at": {"$gte": time.time() - SEMANTIC_CACHE_TTL}}]}
+    try:
+        res = get_semantic_collection(collection_name).query(query_texts=[key_text], n_results=1, where=where)
+    except Exception as e:
+        print(f"[SEMANTIC CACHE ERROR] {e}")
+        return None
+    if res["ids"][0] and res["distances"][0][0] < SEMANTIC_CACHE_MAX_DISTANCE:
+        return res["metadatas"][0][0]["value"]
+    return None
+
+def semantic_store(collection_name: str, key_text: str, value: str, filters: Dict[str, str]) -> None:
+    if value.startswith("⚠️"):
+        return
+    entry_id = hashlib.sha256(orjson.dumps([key_text, filters], option=orjson.OPT_SORT_KEYS)).hexdigest()
+    try:
+        get_semantic_collection(collection_name).upsert(
+            ids=[entry_id],
+            documents=[key_text],
+            metadatas=[{**filters, "value": value, "created_at": time.time()}],
+        )
+    except Exception as e:
+        print(f"[SEMANTIC CACHE ERROR] {e}")
+
+# The cached helpers below raise LookupError instead of returning a fallback,
+# so st.cache_data never pins the result of a transient SerpAPI failure.
+@st.cache_data(ttl=3600, show_spinner=False)
+def _lookup_product_description(product_name: str, niche: str) -> str:
+    cache_text = f"{product_name}|{niche}"
+    cache_filters = {"product": normalize_product_name(product_name)}
+    cached = semantic_lookup("descriptions", cache_text, cache_filters)
+    if cached is not None:
+        return cached
     query = f"{product_name} {niche} tool description"
     data = serp_search(query)
     description = ""
@@ -140,92 +401,267 @@ def fetch_product_description(product_name: str, niche: str) -> str:
             description = snippet
             break
     if not description:
-        description = f"{product_name} in the {niche} space."
+        raise LookupError(f"no description found for {product_name!r}")
+    semantic_store("descriptions", cache_text, description, cache_filters)
     return description
 
+def fetch_product_description(product_name: str, niche: str) -> str:
+    try:
+        return _lookup_product_description(product_name, niche)
+    except LookupError:
+        return f"{product_name} in the {niche} space."
+
 # ----------------- LLM CALL -----------------
 OPENROUTER_CHAT_URL = "https://openrouter.ai/api/v1/chat/completions"
+LLM_CACHE_TTL = 86400  # seconds
+LLM_MAX_TOKENS = 1500
+LLM_MAX_TOKENS_CAP = 8000  # upper bound when a call's budget scales with its inputs
+
+llm_cache = get_disk_cache(".llm_cache")
+
+def _llm_cache_key(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: float,
+    response_format: Optional[Dict[str, str]] = None,
+    max_tokens: int = LLM_MAX_TOKENS,
+) -> str:
+    blob = orjson.dumps(
+        {"m": model, "t": temperature, "msgs": messages, "rf": response_format, "mt": max_tokens},
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(blob).hexdigest()
 
-def llm_chat(messages: List[Dict[str, str]], model: Optional[str] = None, temperature: float = 0.2) -> str:
-    model = model or LLM_MODEL
+def _is_cacheable(content: str, response_format: Optional[Dict[str, str]]) -> bool:
+    if content.startswith("⚠️"):
+        return False
+    # A truncated or malformed JSON answer would otherwise fail the same way for a day.
+    if response_format and response_format.get("type") == "json_object":
+        try:
+            orjson.loads(content)
+        except ValueError:
+            return False
+    return True
+
+def with_prompt_caching(messages: List[Dict[str, str]], model: str) -> List[Dict[str, Any]]:
+    # Anthropic models only cache prefixes explicitly tagged with cache_control;
+    # other providers behind OpenRouter cache automatically.
+    if not model.startswith("anthropic/") or messages[0]["role"] != "system":
+        return messages
+    system = {
+        "role": "system",
+        "content": [{"type": "text", "text": messages[0]["content"], "cache_control": {"type": "ephemeral"}}],
+    }
+    return [system] + messages[1:]
+
+def _llm_request(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: float,
+    response_format: Optional[Dict[str, str]] = None,
+    max_tokens: int = LLM_MAX_TOKENS,
+) -> Tuple[Dict[str, str], Dict[str, Any]]:
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json",
     }
-    payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": 1500}
+    payload = {
+        "model": model,
+        "messages": with_prompt_caching(messages, model),
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "prompt_cache_key": hashlib.md5(messages[0]["content"].encode()).hexdigest(),
+    }
+    if response_format:
+        payload["response_format"] = response_format
+    return headers, payload
+
+def llm_chat(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    temperature: float = 0.2,
+    stream: bool = False,
+    response_format: Optional[Dict[str, str]] = None,
+    errors: Optional[List[str]] = None,
+    max_tokens: int = LLM_MAX_TOKENS,
+) -> Union[str, Iterator[str]]:
+    model = model or LLM_MODEL
+    cache_key = _llm_cache_key(messages, model, temperature, response_format, max_tokens)
+    cached = llm_cache.get(cache_key)
+    if stream:
+        if cached is not None:
+            return iter([cached])
+        return _llm_chat_stream(cache_key, messages, model, temperature, response_format, errors, max_tokens)
+    if cached is not None:
+        return cached
+    headers, payload = _llm_request(messages, model, temperature, response_format, max_tokens)
     try:
-        res = requests.post(OPENROUTER_CHAT_URL, headers=headers, json=payload, timeout=120)
+        res = SESSION.post(OPENROUTER_CHAT_URL, headers=headers, json=payload, timeout=120)
         res.raise_for_status()
-        data = res.json()
-        return data["choices"][0]["message"]["content"]
-    except requests.HTTPError as http_err:
+        data = orjson.loads(res.content)
+        choice = data["choices"][0]
+        content = choice["message"]["content"]
+        # A max_tokens cut-off ("length") is returned but not cached.
+        if choice.get("finish_reason") == "stop" and _is_cacheable(content, response_format):
+            llm_cache.set(cache_key, content, expire=LLM_CACHE_TTL)
+        return content
+    except httpx.HTTPStatusError as http_err:
         st.error(f"[LLM ERROR] HTTP {res.status_code}: {res.text}")
     except Exception as e:
         st.error(f"[LLM ERROR] {e}")
     return "⚠️ LLM error. Please retry."
 
+def _llm_chat_stream(
+    cache_key: str,
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: float,
+    response_format: Optional[Dict[str, str]] = None,
+    errors: Optional[List[str]] = None,
+    max_tokens: int = LLM_MAX_TOKENS,
+) -> Iterator[str]:
+    # Errors go to `errors` when given, so callers rendering the stream into a
+    # placeholder can show them after clearing it; otherwise st.error directly.
+    report = errors.append if errors is not None else st.error
+    headers, payload = _llm_request(messages, model, temperature, response_format, max_tokens)
+    payload["stream"] = True
+    chunks: List[str] = []
+    finish_reason: Optional[str] = None
+    complete = False
+    try:
+        with SESSION.stream("POST", OPENROUTER_CHAT_URL, headers=headers, json=payload, timeout=120) as res:
+            if res.is_error:
+                res.read()
+            res.raise_for_status()
+            for line in res.iter_lines():
+                # SSE: skip keep-alive comments such as ": OPENROUTER PROCESSING"
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                choice = orjson.loads(data)["choices"][0]
+                delta = choice["delta"].get("content")
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+                finish_reason = choice.get("finish_reason") or finish_reason
+        # Only a natural stop counts; "length" means max_tokens cut the answer off.
+        complete = finish_reason == "stop"
+        if not complete:
+            report(f"[LLM ERROR] Response incomplete (finish_reason={finish_reason}).")
+    except httpx.HTTPStatusError as http_err:
+        report(f"[LLM ERROR] HTTP {http_err.response.status_code}: {http_err.response.text}")
+    except Exception as e:
+        complete = False
+        report(f"[LLM ERROR] {e}")
+    content = "".join(chunks)
+    # Never cache a truncated answer; callers see the usual error marker instead.
+    if not complete or not content:
+        yield "⚠️ LLM error. Please retry."
+    elif _is_cacheable(content, response_format):
+        llm_cache.set(cache_key, content, expire=LLM_CACHE_TTL)
 
-def build_analyst_prompt(product_name: str, description: str, aspects: List[str]) -> str:
-    aspects_str = ", ".join(aspects) if aspects else "Pricing, Features, User Interface"
-    return f"""
-You are an expert SaaS product analyst.
 
-Given the product name and description below:
+# Static instructions live in the system prompt so the cached prefix is shared
+# between analyses; only the product details in the user message vary.
+SYSTEM_PROMPT = """You are an expert SaaS product analyst.
 
-Product: {product_name}
-Description: {description}
-Aspects to compare: {aspects_str}
+Given the product name, description and aspects to compare supplied by the user:
 
 1. Identify 6 direct competitors.
-2. Compare all 7 products on these aspects: {aspects_str}.
+2. Compare all 7 products on the requested aspects.
 3. Present the comparison in a markdown table.
 4. Highlight strengths and weaknesses of the given input.
 5. Recommend best use cases.
 6. Improvements needed for the product.
 """
 
-def analyze_competitors(product_name: str, description: str, aspects: List[str]) -> str:
+@st.cache_data(ttl=3600, show_spinner=False)
+def build_analyst_prompt(product_name: str, description: str, aspects: List[str]) -> str:
+    aspects_str = ", ".join(aspects) if aspects else "Pricing, Features, User Interface"
+    return f"""
+Product: {product_name}
+Description: {description}
+Aspects to compare: {aspects_str}
+"""
+
+def build_analyst_messages(product_name: str, description: str, aspects: List[str]) -> List[Dict[str, str]]:
     prompt = build_analyst_prompt(product_name, description, aspects)
-    messages = [
-        {"role": "system", "content": "You are an expert SaaS product analyst."},
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": prompt},
     ]
-    return llm_chat(messages)
+
+def stream_analyze_competitors(
+    product_name: str, description: str, aspects: List[str], errors: Optional[List[str]] = None
+) -> Iterator[str]:
+    yield from llm_chat(build_analyst_messages(product_name, description, aspects), stream=True, errors=errors)
 
 # ----------------- TRACKING COMPETITORS -----------------
 KNOWN_CHANGELOG_PATTERNS = ["/changelog", "/release-notes", "/releases", "/updates"]
 
-def guess_domain_from_name(name: str) -> Optional[str]:
-    data = serp_search(name)
-    for res in data.get("organic_results", []):
+def domain_from_results(results: List[Dict[str, Any]], label: Optional[str] = None) -> Optional[str]:
+    # With `label`, only hosts having it as a whole hostname label match, so
+    # "linear" accepts linear.app but not linearb.io.
+    for res in results:
         link = res.get("link")
         if not link:
             continue
-        m = re.match(r"https?://([^/]+)/?", link)
-        if m:
-            return m.group(1)
+        try:
+            parts = urlsplit(link)
+        except ValueError:  # e.g. an unbalanced IPv6 bracket
+            continue
+        host = parts.hostname
+        if host and (label is None or label in host.split(".")):
+            # netloc keeps the port and IPv6 brackets; drop any userinfo.
+            return parts.netloc.rpartition("@")[2]
     return None
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def _lookup_domain(name: str) -> str:
+    dom = domain_from_results(serp_search(name).get("organic_results", []))
+    if dom is None:
+        raise LookupError(f"no domain found for {name!r}")
+    return dom
+
+def guess_domain_from_name(name: str) -> Optional[str]:
+    try:
+        return _lookup_domain(name)
+    except LookupError:
+        return None
+
 def fetch_changelog_html(url: str, timeout: int = 20) -> Optional[str]:
     try:
-        r = requests.get(url, timeout=timeout)
+        r = SESSION.get(url, timeout=timeout)
         r.raise_for_status()
         return r.text
     except Exception as e:
         print(f"[CHANGELOG FETCH ERROR] {url}: {e}")
         return None
 
+@st.cache_data(ttl=3600, show_spinner=False)
 def extract_top_text_from_html(html_text: str, max_items: int = 5) -> List[str]:
+    from bs4 import BeautifulSoup, NavigableString  # deferred: only needed when scraping changelogs
     soup = BeautifulSoup(html_text, "lxml")
     items: List[str] = []
-    for li in soup.select("li"):
-        txt = li.get_text(" ", strip=True)
+    for li in soup.find_all("li"):
+        # A single plain-text child can be read without walking the subtree; comments,
+        # <script> and <style> children (NavigableString subclasses) still go through get_text.
+        txt = li.string.strip() if type(li.string) is NavigableString else li.get_text(" ", strip=True)
         if txt and len(txt) > 20:
             items.append(txt)
         if len(items) >= max_items:
             break
     return items
 
+def scrape_changelog(url: str, max_items: int = 5) -> List[str]:
+    # Runs on a worker thread so parsing one page overlaps other downloads.
+    html_text = fetch_changelog_html(url)
+    if not html_text:
+        return []
+    return extract_top_text_from_html(html_text, max_items=max_items)
+
 def fetch_competitor_updates(name: str, max_items: int = 5) -> List[Tuple[str, str]]:
     snippets: List[Tuple[str, str]] = []
     serp_q = f"{name} changelog"
@@ -238,14 +674,17 @@ def fetch_competitor_updates(name: str, max_items: int = 5) -> List[Tuple[str, s
         if len(snippets) >= max_items:
             break
     if len(snippets) < max_items:
-        dom = guess_domain_from_name(name)
+        # Reuse the changelog search when it links to the competitor's own site;
+        # third-party hosts (github.com, producthunt.com, ...) don't count, and
+        # names that normalise to "" (e.g. ".NET") skip the reuse entirely.
+        label = normalize_product_name(name)
+        dom = label and domain_from_results(data.get("organic_results", []), label=label)
+        dom = dom or guess_domain_from_name(name)
         if dom:
-            for pat in KNOWN_CHANGELOG_PATTERNS:
-                url = f"https://{dom}{pat}"
-                html_text = fetch_changelog_html(url)
-                if not html_text:
-                    continue
-                texts = extract_top_text_from_html(html_text, max_items=max_items)
+            urls = [f"https://{dom}{pat}" for pat in KNOWN_CHANGELOG_PATTERNS]
+            with thread_pool(len(urls)) as pool:
+                pages = list(pool.map(scrape_changelog, urls, [max_items] * len(urls)))
+            for url, texts in zip(urls, pages):
                 for t in texts:
                     snippets.append((url, t))
                     if len(snippets) >= max_items:
@@ -264,13 +703,77 @@ Summarize updates for {name}:
     messages = [{"role": "user", "content": prompt}]
     return llm_chat(messages)
 
+BATCH_SUMMARY_PROMPT = """Summarize each competitor's updates separately.
+Return a JSON object keyed by the exact competitor name, where each value is a markdown summary of that competitor's updates.
+"""
+
+def batch_summarize_competitor_updates(updates_per_name: Dict[str, List[Tuple[str, str]]]) -> Dict[str, str]:
+    # One LLM round-trip for every competitor instead of one per competitor.
+    summaries = {
+        name: f"No recent updates found for **{name}**."
+        for name, updates in updates_per_name.items() if not updates
+    }
+    pending = {name: updates for name, updates in updates_per_name.items() if updates}
+    if not pending:
+        return summaries
+    sections = []
+    for name, updates in pending.items():
+        lines = "\n".join(f"- {text} (Source: {src})" for src, text in updates)
+        sections.append(f"{name}\n{lines}")
+    messages = [
+        {"role": "system", "content": BATCH_SUMMARY_PROMPT},
+        {"role": "user", "content": "\n\n".join(sections)},
+    ]
+    # Keep each competitor's old per-call budget so the JSON isn't cut off mid-way.
+    max_tokens = min(LLM_MAX_TOKENS * len(pending), LLM_MAX_TOKENS_CAP)
+    raw = llm_chat(messages, response_format={"type": "json_object"}, max_tokens=max_tokens)
+    try:
+        parsed = orjson.loads(raw)
+    except ValueError:
+        parsed = {}
+    if not isinstance(parsed, dict):
+        parsed = {}
+    missing = []
+    for name in pending:
+        summary = parsed.get(name)
+        if isinstance(summary, str) and summary:
+            summaries[name] = summary
+        else:
+            missing.append(name)
+    if missing:
+        # Fall back to dedicated calls, concurrently, for anything the batch answer missed.
+        with thread_pool(8) as pool:
+            fallback = pool.map(summarize_competitor_updates, missing, [pending[name] for name in missing])
+            summaries.update(zip(missing, fallback))
+    return summaries
+
 # ----------------- ANALYSIS BUTTON -----------------
 analysis_md = None
 if st.button("🔍 Discover Competitors & Analyze"):
     if product_name and niche:
         with st.spinner("Analyzing competitors..."):
-            desc = fetch_product_description(product_name, niche)
-            analysis_md = analyze_competitors(product_name, desc, selected_aspects)
+            cache_text = f"{product_name}|{niche}"
+            cache_filters = {
+                "product": normalize_product_name(product_name),
+                "aspects": "|".join(sorted(selected_aspects)),
+            }
+            analysis_md = semantic_lookup("analyses", cache_text, cache_filters)
+            if analysis_md is None:
+                desc = fetch_product_description(product_name, niche)
+                # Render tokens as they arrive; the full report is shown below once done.
+                stream_errors: List[str] = []
+                stream_box = st.empty()
+                with stream_box.container():
+                    analysis_md = st.write_stream(
+                        stream_analyze_competitors(product_name, desc, selected_aspects, errors=stream_errors)
+                    )
+                stream_box.empty()
+                for err in stream_errors:
+                    st.error(err)
+                if stream_errors:
+                    # Drop any partial text so it is neither shown as a report nor cached.
+                    analysis_md = "⚠️ LLM error. Please retry."
+                semantic_store("analyses", cache_text, analysis_md, cache_filters)
             st.session_state["analysis_md"] = analysis_md
     else:
         st.warning("Enter both product name and niche.")
@@ -287,13 +790,7 @@ if analysis_md:
     # Export PDF 
     
     st.subheader("📄 Export Report")
-    buffer = BytesIO()
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name='CustomBody', fontSize=11, leading=16))
-    flow = [Paragraph(line, styles['CustomBody']) for line in analysis_md.split("\n\n")]
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    doc.build(flow)
-    pdf_bytes = buffer.getvalue()
+    pdf_bytes = md_to_pdf(analysis_md)
 
     st.download_button("Download PDF", pdf_bytes, file_name="Competitor_Report.pdf", mime="application/pdf")
 
@@ -320,10 +817,12 @@ if st.button("Fetch Updates"):
         all_updates_md = ""
 
         with st.spinner("⏳ Fetching competitor updates..."):
-            for comp in comp_list:
-                updates = fetch_competitor_updates(comp)
-                summary = summarize_competitor_updates(comp, updates)
+            with thread_pool(8) as pool:
+                all_updates = dict(zip(comp_list, pool.map(fetch_competitor_updates, comp_list)))
+            summaries = batch_summarize_competitor_updates(all_updates)
 
+            for comp in comp_list:
+                summary = summaries[comp]
                 st.markdown(f"### 🔍 {comp}")
                 st.markdown(summary)
                 all_updates_md += f"## {comp}\n\n{summary}\n\n"
@@ -332,22 +831,9 @@ if st.button("Fetch Updates"):
 
         # Generate PDF and store in session state
         if all_updates_md.strip():
-            track_buffer = BytesIO()
-            styles = getSampleStyleSheet()
-            styles.add(ParagraphStyle(name='CustomBody', fontSize=11, leading=16, textColor=colors.black))
-            link_style = ParagraphStyle(name='Link', fontSize=11, textColor=colors.HexColor("#0000FF"))
-
-            flow = []
-            for line in all_updates_md.split("\n\n"):
-                if "http" in line:  # Make links blue
-                    flow.append(Paragraph(f"<font color='blue'>{line}</font>", link_style))
-                else:
-                    flow.append(Paragraph(line, styles['CustomBody']))
-                flow.append(Spacer(1, 8))
-
-            track_doc = SimpleDocTemplate(track_buffer, pagesize=A4)
-            track_doc.build(flow)
-            st.session_state.track_pdf_bytes = track_buffer.getvalue()
+            # Stored once as bytes: download_button passes bytes through unchanged,
+            # whereas a BytesIO would be re-copied with getvalue() on every rerun.
+            st.session_state.track_pdf_bytes = updates_md_to_pdf(all_updates_md)
 
     else:
         st.warning("Please enter competitor names to fetch updates.")
@@ -362,10 +848,22 @@ if "track_pdf_bytes" in st.session_state:
     )
 
     email = st.text_input("Enter your email to receive the report:")
+
+    # Report the outcome of a background send on the first rerun after it finishes.
+    email_future = st.session_state.get("email_future")
+    if email_future is not None and email_future.done():
+        del st.session_state["email_future"]
+        if email_future.exception():
+            st.error(f"Email sending failed: {email_future.exception()}")
+        else:
+            st.success("✅ Email sent successfully!")
+
     if st.button("Send Report via Email"):
         if email:
-            if send_email_with_pdf(email, st.session_state.track_pdf_bytes):
-                st.success("✅ Email sent successfully!")
+            st.session_state["email_future"] = get_email_executor().submit(
+                send_email_with_pdf, email, st.session_state.track_pdf_bytes, get_smtp_state()
+            )
+            st.success("📨 Email queued, sending in the background.")
         else:
             st.warning("Please enter a valid email.")
 